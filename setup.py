@@ -26,8 +26,9 @@ setup(
     long_description=read('README.rst'),
     install_requires=[
         'eventlet',
+        'monotonic; python_version < "3.3"',
         ],
     tests_require=[
-        'mox',
+        'mock',
         ],
     )
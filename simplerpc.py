@@ -13,34 +13,138 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import functools
+import hmac
 import json
 import logging
 import socket
+import struct
 import sys
-import time
 
 import eventlet
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the time module
+    from monotonic import monotonic
+
 
 LOG = logging.getLogger('simplerpc')
 
 
+# The wire codec: a preconstructed encoder producing compact output,
+# and a preconstructed decoder
+_json_dumps = json.JSONEncoder(separators=(',', ':')).encode
+_json_loads = json.JSONDecoder().decode
+
+
+# Clock used to time pings; a monotonic clock is immune to changes of
+# the system time
+_clock = monotonic
+
+
+# The commands of the protocol; received commands are replaced by
+# these strings, so that comparisons against them are fast
+_known_commands = dict((cmd, cmd) for cmd in (
+    'AUTH', 'OK', 'ERR', 'QUIT', 'PING', 'PONG', 'CALL', 'RES', 'EXC',
+))
+
+
+# Cache of classes looked up by _import_class()
+_class_cache = {}
+
+
 def _import_class(import_str):
-    """Returns a class from a string including module and class."""
+    """
+    Returns a class from a string including module and class.
+    Successful lookups are cached.
+    """
+
+    try:
+        return _class_cache[import_str]
+    except KeyError:
+        pass
 
     mod_str, _sep, class_str = import_str.rpartition(':')
     try:
         __import__(mod_str)
-        return getattr(sys.modules[mod_str], class_str)
+        cls = getattr(sys.modules[mod_str], class_str)
     except (ImportError, ValueError, AttributeError) as exc:
         # Convert it into an import error
         raise ImportError("Failed to import %s: %s" % (import_str, exc))
 
+    _class_cache[import_str] = cls
+    return cls
+
+
+# Cache of exception names computed by _exception_name()
+_exc_name_cache = {}
+
+
+def _exception_name(exc_type):
+    """
+    Returns the name of an exception class as a string including
+    module and class, suitable for _import_class().  Names are cached.
+    """
+
+    try:
+        return _exc_name_cache[exc_type]
+    except KeyError:
+        pass
+
+    name = '%s:%s' % (exc_type.__module__, exc_type.__name__)
+    _exc_name_cache[exc_type] = name
+    return name
+
+
+def _decode_message(data):
+    """
+    Decode a message received from the other end.  Returns a tuple of
+    the command and payload; raises ValueError if the message cannot
+    be parsed or is not a valid message.
+    """
+
+    msg = _json_loads(data)
+    try:
+        cmd = msg['cmd']
+        payload = msg['payload']
+    except (TypeError, KeyError):
+        # Don't echo the message back; it may be arbitrarily large
+        raise ValueError("Invalid message: expected an object with "
+                         "'cmd' and 'payload'")
+
+    # Canonicalize the command
+    try:
+        cmd = _known_commands.get(cmd, cmd)
+    except TypeError:
+        # Unhashable, so it can't be a known command
+        pass
+
+    return cmd, payload
+
+
+def _key_bytes(key):
+    """
+    Returns an authentication key as bytes, for comparison by
+    hmac.compare_digest().  Returns None if the key is not a string.
+    """
+
+    if isinstance(key, bytes):
+        return key
+
+    try:
+        return key.encode('utf-8')
+    except AttributeError:
+        return None
+
 
 class _ignore_except(object):
     """Context manager to ignore all exceptions."""
 
+    __slots__ = ()
+
     def __enter__(self):
         """Entry does nothing."""
 
@@ -58,15 +162,149 @@ class ConnectionClosed(Exception):
     pass
 
 
+class LineFramer(object):
+    """
+    Frames messages by terminating each with a newline.  This is the
+    default framing.
+    """
+
+    def frame(self, msg):
+        """
+        Apply framing to an encoded message.
+
+        :param msg: The encoded message.
+
+        :returns: The framed message, ready to be sent.
+        """
+
+        return msg + b'\n'
+
+    def unframe(self, buf, scan=0):
+        """
+        Extract complete messages from a receive buffer.  The
+        extracted messages are removed from the buffer; any incomplete
+        message is left for a later call.
+
+        :param buf: A bytearray containing the received data.
+        :param scan: The offset in the buffer at which to begin
+                     searching for complete messages.  The caller
+                     guarantees that no complete message ends before
+                     this offset.
+
+        :returns: A list of the extracted messages.
+        """
+
+        msgs = []
+        start = 0
+        idx = buf.find(b'\n', scan)
+        while idx >= 0:
+            msgs.append(bytes(buf[start:idx]))
+
+            # Look for the next message
+            start = idx + 1
+            idx = buf.find(b'\n', start)
+
+        # Discard the extracted messages
+        del buf[:start]
+
+        return msgs
+
+
+# Precompiled length prefix used by LenPrefixFramer
+_length_prefix = struct.Struct('!I')
+
+
+class LenPrefixFramer(object):
+    """
+    Frames messages by prefixing each with its length, as a 4-byte
+    unsigned integer in network byte order.  Finding the end of a
+    message requires no scanning of the message data.  Note that both
+    ends of the connection must use the same framing.
+    """
+
+    def frame(self, msg):
+        """
+        Apply framing to an encoded message.
+
+        :param msg: The encoded message.
+
+        :returns: The framed message, ready to be sent.
+        """
+
+        return _length_prefix.pack(len(msg)) + msg
+
+    def unframe(self, buf, scan=0):
+        """
+        Extract complete messages from a receive buffer.  The
+        extracted messages are removed from the buffer; any incomplete
+        message is left for a later call.
+
+        :param buf: A bytearray containing the received data.
+        :param scan: Ignored.
+
+        :returns: A list of the extracted messages.
+        """
+
+        unpack_from = _length_prefix.unpack_from
+
+        msgs = []
+        start = 0
+        while len(buf) - start >= 4:
+            # Do we have the whole message?
+            size, = unpack_from(buf, start)
+            end = start + 4 + size
+            if len(buf) < end:
+                break
+
+            msgs.append(bytes(buf[start + 4:end]))
+            start = end
+
+        # Discard the extracted messages
+        del buf[:start]
+
+        return msgs
+
+
 class Connection(object):
-    """Buffered network connection."""
+    """
+    Buffered network connection.
+
+    Messages are framed using the framer in the ``framer`` class
+    attribute; this is a LineFramer by default, but may be set to a
+    LenPrefixFramer or any other object with compatible frame() and
+    unframe() methods.
+
+    By default, each message is sent as soon as send() is called.  If
+    the ``flush_on_send`` class attribute is False, outgoing messages
+    are instead accumulated and sent together by a single call to the
+    socket's sendall() method.  The accumulated messages are sent
+    whenever ``flush_size`` bytes are pending, when flush() is
+    called, before recv() waits for a message, and when the
+    connection is closed.
+
+    Connection instances use __slots__, so these settings must be
+    changed by subclassing rather than on individual instances.
+    """
+
+    framer = LineFramer()
+    flush_on_send = True
+    flush_size = 16384
+
+    __slots__ = ('_sock', '_sendbuf', '_recvbuf', '_recvbuf_partial',
+                 '_rxbuf', '_rxview')
 
     def __init__(self, sock):
         """Initialize a Connection object."""
 
         self._sock = sock
-        self._recvbuf = []
-        self._recvbuf_partial = ''
+        self._sendbuf = bytearray()
+        self._recvbuf = collections.deque()
+        self._recvbuf_partial = bytearray()
+
+        # Preallocated buffer for reading from the socket; it lasts as
+        # long as the connection, so keep it small
+        self._rxbuf = bytearray(4096)
+        self._rxview = memoryview(self._rxbuf)
 
     def close(self):
         """
@@ -76,15 +314,24 @@ class Connection(object):
                       be purged.
         """
 
+        # Try to send anything we haven't sent yet; note that flush()
+        # closes the connection if it fails
+        if self._sock:
+            with _ignore_except():
+                self.flush()
+
         # Close the underlying socket
         if self._sock:
             with _ignore_except():
                 self._sock.close()
             self._sock = None
 
+        # Discard anything we couldn't send
+        self._sendbuf = bytearray()
+
         # Purge the message buffers
-        self._recvbuf = []
-        self._recvbuf_partial = ''
+        self._recvbuf = collections.deque()
+        self._recvbuf_partial = bytearray()
 
     def send(self, cmd, *payload):
         """
@@ -100,11 +347,36 @@ class Connection(object):
             raise ConnectionClosed("Connection closed")
 
         # Construct the outgoing message
-        msg = json.dumps(dict(cmd=cmd, payload=payload)) + '\n'
+        msg = self.framer.frame(_json_dumps({'cmd': cmd,
+                                             'payload': payload}))
+
+        # Queue it up for sending
+        self._sendbuf += msg
+
+        # Send it, if appropriate
+        if self.flush_on_send or len(self._sendbuf) >= self.flush_size:
+            self.flush()
 
-        # Send it
+    def flush(self):
+        """
+        Send all pending messages to the other end.
+        """
+
+        # Nothing to do if nothing is pending
+        if not self._sendbuf:
+            return
+
+        # If it's closed, raise an error up front
+        if not self._sock:
+            raise ConnectionClosed("Connection closed")
+
+        # Take the pending messages; they're already contiguous
+        data = self._sendbuf
+        self._sendbuf = bytearray()
+
+        # Send them
         try:
-            self._sock.sendall(msg)
+            self._sock.sendall(data)
         except socket.error:
             # We'll need to re-raise
             e_type, e_value, e_tb = sys.exc_info()
@@ -123,10 +395,10 @@ class Connection(object):
         """
 
         # Pop a message off the recv buffer and return (or raise) it
-        msg = self._recvbuf.pop(0)
+        msg = self._recvbuf.popleft()
         if isinstance(msg, Exception):
             raise msg
-        return msg['cmd'], msg['payload']
+        return msg
 
     def recv(self):
         """
@@ -142,10 +414,14 @@ class Connection(object):
         if not self._sock:
             raise ConnectionClosed("Connection closed")
 
+        # Make sure the other end has everything we've sent before
+        # waiting for a reply
+        self.flush()
+
         # OK, get some data from the socket
         while True:
             try:
-                data = self._sock.recv(4096)
+                size = self._sock.recv_into(self._rxbuf)
             except socket.error:
                 # We'll need to re-raise
                 e_type, e_value, e_tb = sys.exc_info()
@@ -157,26 +433,22 @@ class Connection(object):
                 raise e_type, e_value, e_tb
 
             # Did the connection get closed?
-            if not data:
+            if not size:
                 # There can never be anything in the buffer here
                 self.close()
                 raise ConnectionClosed("Connection closed")
 
-            # Begin parsing the read-in data
-            partial = self._recvbuf_partial + data
-            self._recvbuf_partial = ''
-            while partial:
-                msg, sep, partial = partial.partition('\n')
-
-                # If we have no sep, then it's not a complete message,
-                # and the remainder is in msg
-                if not sep:
-                    self._recvbuf_partial = msg
-                    break
+            # Add the data to the partial buffer; since the buffer
+            # never holds a complete message between calls, the
+            # framer only needs to scan the new data
+            partial = self._recvbuf_partial
+            scan = len(partial)
+            partial += self._rxview[:size]
 
+            for msg in self.framer.unframe(partial, scan):
                 # Parse the message
                 try:
-                    self._recvbuf.append(json.loads(msg))
+                    self._recvbuf.append(_decode_message(msg))
                 except ValueError as exc:
                     # Error parsing the message; save the exception,
                     # which we will re-raise
@@ -208,20 +480,32 @@ def remote(func):
         if not self.conn:
             self.connect()
 
-        # Call the remote function
-        self.conn.send('CALL', func.__name__, args, kwargs)
+        try:
+            # Call the remote function
+            self.conn.send('CALL', func.__name__, args, kwargs)
+
+            # Receive the response
+            cmd, payload = self.conn.recv()
+        except BaseException:
+            # We'll need to re-raise
+            e_type, e_value, e_tb = sys.exc_info()
+
+            # The state of the connection is uncertain, so it must
+            # not be reused
+            self._disconnect()
+
+            # Re-raise
+            raise e_type, e_value, e_tb
 
-        # Receive the response
-        cmd, payload = self.conn.recv()
         if cmd == 'ERR':
-            self.close()
+            self._disconnect()
             raise Exception("Catastrophic error from server: %s" %
                             payload[0])
         elif cmd == 'EXC':
             exc_type = _import_class(payload[0])
             raise exc_type(payload[1])
         elif cmd != 'RES':
-            self.close()
+            self._disconnect()
             raise Exception("Invalid command response from server: %s" % cmd)
 
         return payload[0]
@@ -261,6 +545,99 @@ def _create_server(host, port):
     raise exc
 
 
+class ConnectionPool(object):
+    """
+    A pool of idle, authenticated client connections.  Setting the
+    ``connection_pool`` class attribute of a SimpleRPC subclass to a
+    ConnectionPool causes close() to return the client connection to
+    the pool, and connect() to reuse a pooled connection to the same
+    server, if one is available, instead of establishing and
+    authenticating a new one.
+    """
+
+    def __init__(self, max_idle=8, check_after=30.0):
+        """
+        Initialize a ConnectionPool object.
+
+        :param max_idle: The maximum number of idle connections to
+                         retain for each server.  If 0, connections
+                         are closed instead of being retained.
+        :param check_after: Connections which have been idle for more
+                            than this many seconds are checked with a
+                            PING before being reused.
+        """
+
+        self.max_idle = max_idle
+        self.check_after = check_after
+
+        self._idle = {}
+
+    def _check(self, conn):
+        """
+        Check that a connection is still usable by pinging the other
+        end.  Returns True if the connection is usable.
+
+        :param conn: The Connection instance.
+        """
+
+        try:
+            conn.send('PING', _clock())
+            cmd, payload = conn.recv()
+        except Exception:
+            return False
+
+        return cmd == 'PONG'
+
+    def acquire(self, host, port, authkey):
+        """
+        Retrieve an idle connection from the pool.  Returns None if
+        there is no usable idle connection to the designated server.
+
+        :param host: The host the server listens on.
+        :param port: The TCP port the server listens on.
+        :param authkey: The authentication key used with the server.
+        """
+
+        idle = self._idle.get((host, port, authkey))
+        while idle:
+            # Use the most recently released connection
+            conn, released = idle.pop()
+            if (_clock() - released <= self.check_after or
+                    self._check(conn)):
+                return conn
+
+            # Not usable, so discard it
+            conn.close()
+
+        return None
+
+    def release(self, host, port, authkey, conn):
+        """
+        Return a connection to the pool.
+
+        :param host: The host the server listens on.
+        :param port: The TCP port the server listens on.
+        :param authkey: The authentication key used with the server.
+        :param conn: The Connection instance, which must be idle and
+                     authenticated.
+        """
+
+        # Pooling may be disabled by setting max_idle to 0
+        if self.max_idle <= 0:
+            conn.close()
+            return
+
+        idle = self._idle.setdefault((host, port, authkey),
+                                     collections.deque())
+
+        # Make room by discarding the least recently used connections
+        while idle and len(idle) >= self.max_idle:
+            old_conn, _released = idle.popleft()
+            old_conn.close()
+
+        idle.append((conn, _clock()))
+
+
 class SimpleRPC(object):
     """
     Implements simple remote procedure call.  When run in client mode
@@ -277,6 +654,17 @@ class SimpleRPC(object):
     """
 
     connection_class = Connection
+    connection_pool = None
+
+    # Map commands to the names of their handler methods and whether
+    # the client must be authenticated to use them; unrecognized
+    # commands are handled by _serve_unknown()
+    _serve_commands = {
+        'AUTH': ('_serve_auth', False),
+        'QUIT': ('_serve_quit', False),
+        'PING': ('_serve_ping', True),
+        'CALL': ('_serve_call', True),
+        }
 
     def __init__(self, host, port, authkey):
         """
@@ -297,12 +685,55 @@ class SimpleRPC(object):
         self.mode = None
         self.conn = None
 
+    @classmethod
+    def _remote_funcs(cls):
+        """
+        Returns a dictionary mapping the names of the remote methods
+        of the class to the methods themselves.  The dictionary is
+        computed the first time it is needed and cached on the class.
+        """
+
+        # Use the cached dictionary, if this class has one
+        if '_remote_cache' in cls.__dict__:
+            return cls._remote_cache
+
+        # Collect all the methods marked by @remote
+        remotes = {}
+        for name in dir(cls):
+            func = getattr(cls, name, None)
+            if callable(func) and getattr(func, '_remote', False):
+                # Store plain functions instead of unbound methods;
+                # this spares each call the unbound method type check
+                if getattr(func, '__self__', True) is None:
+                    func = func.__func__
+                remotes[name] = func
+
+        cls._remote_cache = remotes
+        return remotes
+
     def close(self):
         """
-        Close the connection to the server.
+        Close the connection to the server.  If the class has a
+        connection pool, the connection is instead returned to the
+        pool.
         """
 
         # Close the connection
+        if self.conn:
+            if self.connection_pool:
+                self.connection_pool.release(self.host, self.port,
+                                             self.authkey, self.conn)
+            else:
+                self.conn.close()
+        self.conn = None
+
+    def _disconnect(self):
+        """
+        Close the connection to the server without returning it to
+        the connection pool.  Used when the state of the connection is
+        uncertain.
+        """
+
         if self.conn:
             self.conn.close()
         self.conn = None
@@ -318,12 +749,24 @@ class SimpleRPC(object):
             self.connect()
 
         # Send the ping and wait for the response
-        self.conn.send('PING', time.time())
-        cmd, payload = self.conn.recv()
-        recv_ts = time.time()
+        try:
+            self.conn.send('PING', _clock())
+            cmd, payload = self.conn.recv()
+        except BaseException:
+            # We'll need to re-raise
+            e_type, e_value, e_tb = sys.exc_info()
+
+            # The state of the connection is uncertain, so it must
+            # not be reused
+            self._disconnect()
+
+            # Re-raise
+            raise e_type, e_value, e_tb
+        recv_ts = _clock()
 
         # Make sure the response was a PONG
         if cmd != 'PONG':
+            self._disconnect()
             raise Exception("Invalid response from server")
 
         # Return the RTT
@@ -346,6 +789,13 @@ class SimpleRPC(object):
         if self.conn:
             return
 
+        # Reuse a pooled connection, if one is available
+        if self.connection_pool:
+            self.conn = self.connection_pool.acquire(self.host, self.port,
+                                                     self.authkey)
+            if self.conn:
+                return
+
         # OK, attempt the connection
         fd = socket.create_connection((self.host, self.port))
 
@@ -357,24 +807,23 @@ class SimpleRPC(object):
             self.conn.send('AUTH', self.authkey)
             cmd, payload = self.conn.recv()
             if cmd != 'OK':
-                LOG.error("Failed to authenticate to %s port %s: %s" %
-                          (self.host, self.port, payload[0]))
-                self.close()
+                LOG.error("Failed to authenticate to %s port %s: %s",
+                          self.host, self.port, payload[0])
+                self._disconnect()
         except Exception:
             exc_type, exc_value, exc_tb = sys.exc_info()
 
             # Log the error
             if exc_type == ValueError:
-                LOG.error("Received bogus response from server: %s" %
-                          str(exc_value))
+                LOG.error("Received bogus response from server: %s",
+                          exc_value)
             elif exc_type == ConnectionClosed:
-                LOG.error("%s while authenticating to server" %
-                          str(exc_value))
+                LOG.error("%s while authenticating to server", exc_value)
             else:
                 LOG.exception("Failed to authenticate to server")
 
             # Close the connection
-            self.close()
+            self._disconnect()
 
             # Re-raise the exception
             raise exc_type, exc_value, exc_tb
@@ -398,14 +847,18 @@ class SimpleRPC(object):
         # If we have too many errors, we want to bail out
         err_thresh = 0
         while True:
-            # Accept a connection
+            # Accept a connection.  Note that eventlet's green accept()
+            # only yields to the hub when no connection is pending, so
+            # a backlog of connections is drained without yielding;
+            # the listening socket must not be made non-blocking, as
+            # eventlet then hands back non-green client sockets
             try:
                 sock, addr = serv.accept()
             except Exception as exc:
                 err_thresh += 1
                 if err_thresh > 10:
                     LOG.exception("Too many errors accepting "
-                                  "connections: %s" % str(exc))
+                                  "connections: %s", exc)
                     break
                 continue
 
@@ -413,8 +866,8 @@ class SimpleRPC(object):
             err_thresh = max(err_thresh - 1, 0)
 
             # Log the connection attempt
-            LOG.info("Accepted connection from %s port %s" %
-                     (addr[0], addr[1]))
+            LOG.info("Accepted connection from %s port %s",
+                     addr[0], addr[1])
 
             # And handle the connection
             eventlet.spawn_n(self.serve, self.connection_class(sock), addr)
@@ -431,13 +884,30 @@ class SimpleRPC(object):
         :param addr: The address of the client, for logging purposes.
         """
 
+        # Bind the command handlers for the connection; the table is
+        # built here rather than stored on the instance, which would
+        # make the instance refer to itself
+        dispatch = dict((cmd, (getattr(self, name), need_auth))
+                        for cmd, (name, need_auth) in
+                        self._serve_commands.items())
+        dispatch_default = (self._serve_unknown, True)
+
+        # Bind the calls made for every command once for the
+        # connection
+        recv = conn.recv
+        dispatch_get = dispatch.get
+        log_debug = LOG.debug
+
+        # Unpack the client address once, for logging purposes
+        host, port = addr[0], addr[1]
+
         try:
             # Handle data from the client
             auth = False
             while True:
                 # Get the command
                 try:
-                    cmd, payload = conn.recv()
+                    cmd, payload = recv()
                 except ValueError as exc:
                     # Tell the client about the error
                     conn.send('ERR', "Failed to parse command: %s" % str(exc))
@@ -449,82 +919,133 @@ class SimpleRPC(object):
                     continue
 
                 # Log the command and payload, for debugging purposes
-                LOG.debug("Received command %r from %s port %s; payload: %r" %
-                          (cmd, addr[0], addr[1], payload))
-
-                # Handle authentication
-                if cmd == 'AUTH':
-                    if auth:
-                        conn.send('ERR', "Already authenticated")
-                    elif payload[0] != self.authkey:
-                        # Don't give them a second chance
-                        conn.send('ERR', "Invalid authentication key")
-                        return
-                    else:
-                        # Authentication successful
-                        conn.send('OK')
-                        auth = True
+                log_debug("Received command %r from %s port %s; payload: %r",
+                          cmd, host, port, payload)
 
-                # Special QUIT command for testing purposes
-                elif cmd == 'QUIT':
-                    return
+                # Look up the command handler
+                try:
+                    handler, need_auth = dispatch_get(cmd, dispatch_default)
+                except TypeError:
+                    # Unhashable, so it can't be a valid command
+                    handler, need_auth = dispatch_default
 
                 # Handle unauthenticated connections
-                elif not auth:
+                if need_auth and not auth:
                     # No second chances
                     conn.send('ERR', "Not authenticated")
                     return
 
-                # Handle aliveness test
-                elif cmd == 'PING':
-                    conn.send('PONG', *payload)
-
-                # Handle a function call command
-                elif cmd == 'CALL':
-                    try:
-                        # Get the call parameters
-                        try:
-                            funcname, args, kwargs = payload
-                        except ValueError as exc:
-                            conn.send('ERR', "Invalid payload for 'CALL' "
-                                      "command: %s" % str(exc))
-                            continue
-
-                        # Look up the function
-                        func = getattr(self, funcname, None)
-                        if (not func or
-                            not callable(func) or
-                            not getattr(func, '_remote', False)):
-                            raise AttributeError(
-                                "%r object has no attribute %r" %
-                                (self.__class__.__name__, funcname))
-
-                        # Call the function
-                        result = func(*args, **kwargs)
-                    except Exception as exc:
-                        exc_name = '%s:%s' % (exc.__class__.__module__,
-                                              exc.__class__.__name__)
-                        conn.send('EXC', exc_name, str(exc))
-                    else:
-                        # Return the result
-                        conn.send('RES', result)
-
-                # Handle all other commands by returning an ERR
-                else:
-                    conn.send('ERR', "Unrecognized command %r" % cmd)
+                # Handle the command
+                auth = handler(conn, cmd, payload, auth)
+                if auth is None:
+                    return
 
         except ConnectionClosed:
             # Ignore the connection closed error
             pass
         except Exception as exc:
             # Log other exceptions
-            LOG.exception("Error serving client at %s port %s: %s" %
-                          (addr[0], addr[1], str(exc)))
+            LOG.exception("Error serving client at %s port %s: %s",
+                          host, port, exc)
             pass
 
         finally:
-            LOG.info("Closing connection from %s port %s" %
-                     (addr[0], addr[1]))
+            LOG.info("Closing connection from %s port %s", host, port)
 
             # Make sure the socket gets closed
             conn.close()
+
+    def _serve_auth(self, conn, cmd, payload, auth):
+        """
+        Handle the AUTH command.
+
+        :param conn: The Connection instance.
+        :param cmd: The command.
+        :param payload: The command payload.
+        :param auth: True if the client has already authenticated.
+
+        :returns: The new authentication state of the client, or None
+                  if the connection should be closed.  All the
+                  _serve_*() handlers share this signature.
+        """
+
+        if auth:
+            conn.send('ERR', "Already authenticated")
+            return auth
+
+        # Compare string keys in constant time; other keys can only
+        # be compared for equality
+        key = _key_bytes(payload[0])
+        authkey = _key_bytes(self.authkey)
+        if key is None or authkey is None:
+            valid = payload[0] == self.authkey
+        else:
+            valid = hmac.compare_digest(key, authkey)
+        if not valid:
+            # Don't give them a second chance
+            conn.send('ERR', "Invalid authentication key")
+            return None
+
+        # Authentication successful
+        conn.send('OK')
+        return True
+
+    def _serve_quit(self, conn, cmd, payload, auth):
+        """
+        Handle the QUIT command, which exists for testing purposes.
+        """
+
+        return None
+
+    def _serve_ping(self, conn, cmd, payload, auth):
+        """
+        Handle the PING command, an aliveness test.
+        """
+
+        conn.send('PONG', *payload)
+        return auth
+
+    def _serve_call(self, conn, cmd, payload, auth):
+        """
+        Handle the CALL command, a function call.
+        """
+
+        try:
+            # Get the call parameters
+            if len(payload) != 3:
+                conn.send('ERR', "Invalid payload for 'CALL' command: "
+                          "expected 3 elements, received %d" % len(payload))
+                return auth
+            funcname, args, kwargs = payload
+
+            # Look up the function
+            func = self._remote_funcs().get(funcname)
+            if func is None:
+                raise AttributeError(
+                    "%r object has no attribute %r" %
+                    (self.__class__.__name__, funcname))
+
+            # Call the function; most calls pass no keyword arguments,
+            # and leaving out the empty dictionary makes them cheaper.
+            # Anything but a dictionary goes through ** unpacking, so
+            # that it is rejected as before
+            if kwargs or not isinstance(kwargs, dict):
+                result = func(self, *args, **kwargs)
+            else:
+                result = func(self, *args)
+        except Exception as exc:
+            conn.send('EXC', _exception_name(exc.__class__), str(exc))
+        else:
+            # Return the result
+            conn.send('RES', result)
+
+        return auth
+
+    def _serve_unknown(self, conn, cmd, payload, auth):
+        """
+        Handle all unrecognized commands by returning an ERR.
+        """
+
+        conn.send('ERR', "Unrecognized command %r" % cmd)
+        return auth
+
@@ -13,15 +13,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import errno
 import json
 import logging
 import socket
-import time
+import struct
 import unittest
+import weakref
 
 import eventlet
-import stubout
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import simplerpc
 
@@ -29,23 +35,25 @@ import simplerpc
 LOG = logging.getLogger('simplerpc')
 
 
+# Save the real _import_class(), since TestCase stubs it out
+real_import_class = simplerpc._import_class
+
+
 class TestHandler(logging.Handler, object):
     def __init__(self):
         super(TestHandler, self).__init__(logging.DEBUG)
 
-        self.messages = []
+        self.messages = collections.deque()
 
     def emit(self, record):
-        try:
-            self.messages.append(self.format(record))
-        except Exception:
-            pass
+        # Only the message itself is of interest
+        self.messages.append(record.getMessage())
 
     def get_messages(self, clear=False):
         # Get the list of messages and clear it
-        messages = self.messages
+        messages = list(self.messages)
         if clear:
-            self.messages = []
+            self.messages.clear()
         return messages
 
 
@@ -60,8 +68,6 @@ class TestCase(unittest.TestCase):
     imports = {}
 
     def setUp(self):
-        self.stubs = stubout.StubOutForTesting()
-
         def fake_import(import_str):
             try:
                 return self.imports[import_str]
@@ -70,17 +76,21 @@ class TestCase(unittest.TestCase):
                 raise ImportError("Failed to import %s: %s" %
                                   (import_str, exc))
 
-        self.stubs.Set(simplerpc, '_import_class', fake_import)
+        self.stub(simplerpc, '_import_class', fake_import)
 
         # Clear the log messages
         test_handler.get_messages(True)
 
     def tearDown(self):
-        self.stubs.UnsetAll()
-
         # Clear the log messages
         test_handler.get_messages(True)
 
+    def stub(self, obj, attr, new):
+        # Replace the attribute for the duration of the test
+        patcher = mock.patch.object(obj, attr, new)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @property
     def log_messages(self):
         # Retrieve and clear test log messages
@@ -92,6 +102,95 @@ def throw_except(exc_type):
         raise exc_type('Thrown')
 
 
+class TestImportClass(TestCase):
+    def setUp(self):
+        super(TestImportClass, self).setUp()
+
+        self.stub(simplerpc, '_class_cache', {})
+
+    def test_import_class(self):
+        result = real_import_class('test_simplerpc:TestException')
+
+        self.assertEqual(result, TestException)
+        self.assertEqual(simplerpc._class_cache, {
+                'test_simplerpc:TestException': TestException,
+                })
+
+    def test_import_class_cached(self):
+        simplerpc._class_cache['test_simplerpc:TestException'] = 'cached'
+
+        result = real_import_class('test_simplerpc:TestException')
+
+        self.assertEqual(result, 'cached')
+
+    def test_import_class_nosuch(self):
+        self.assertRaises(ImportError, real_import_class,
+                          'test_simplerpc:NoSuchException')
+        self.assertEqual(simplerpc._class_cache, {})
+
+
+class TestExceptionName(TestCase):
+    def setUp(self):
+        super(TestExceptionName, self).setUp()
+
+        self.stub(simplerpc, '_exc_name_cache', {})
+
+    def test_exception_name(self):
+        result = simplerpc._exception_name(TestException)
+
+        self.assertEqual(result, 'test_simplerpc:TestException')
+        self.assertEqual(simplerpc._exc_name_cache, {
+                TestException: 'test_simplerpc:TestException',
+                })
+
+    def test_exception_name_cached(self):
+        simplerpc._exc_name_cache[TestException] = 'cached'
+
+        result = simplerpc._exception_name(TestException)
+
+        self.assertEqual(result, 'cached')
+
+
+class TestDecodeMessage(TestCase):
+    def test_decode_message(self):
+        result = simplerpc._decode_message(
+            b'{"cmd": "FOO", "payload": ["spam"]}')
+
+        self.assertEqual(result, ('FOO', ['spam']))
+
+    def test_decode_message_known_cmd(self):
+        result = simplerpc._decode_message(
+            b'{"cmd": "PING", "payload": [11111]}')
+
+        self.assertEqual(result, ('PING', [11111]))
+        self.assertTrue(result[0] is simplerpc._known_commands['PING'])
+
+    def test_decode_message_unhashable_cmd(self):
+        result = simplerpc._decode_message(
+            b'{"cmd": ["PING"], "payload": [11111]}')
+
+        self.assertEqual(result, (['PING'], [11111]))
+
+    def test_decode_message_badparse(self):
+        self.assertRaises(ValueError, simplerpc._decode_message, b'{"cmd"')
+
+    def test_decode_message_notdict(self):
+        try:
+            simplerpc._decode_message(b'["FOO", ["spam"]]')
+            self.fail("Failed to raise ValueError")
+        except ValueError as exc:
+            self.assertEqual(str(exc), "Invalid message: expected an "
+                             "object with 'cmd' and 'payload'")
+
+    def test_decode_message_missing(self):
+        try:
+            simplerpc._decode_message(b'{"cmd": "FOO"}')
+            self.fail("Failed to raise ValueError")
+        except ValueError as exc:
+            self.assertEqual(str(exc), "Invalid message: expected an "
+                             "object with 'cmd' and 'payload'")
+
+
 class TestIgnoreExcept(TestCase):
     def test_ignore_except_no_error(self):
         # Shouldn't raise any exceptions
@@ -113,18 +212,75 @@ class TestIgnoreExcept(TestCase):
         self.assertEqual(finished, False)
 
 
+class TestLineFramer(TestCase):
+    def test_frame(self):
+        framer = simplerpc.LineFramer()
+
+        self.assertEqual(framer.frame(b'foo'), b'foo\n')
+
+    def test_unframe(self):
+        framer = simplerpc.LineFramer()
+        buf = bytearray(b'foo\nbar\nba')
+
+        result = framer.unframe(buf)
+
+        self.assertEqual(result, [b'foo', b'bar'])
+        self.assertEqual(buf, b'ba')
+
+    def test_unframe_scan(self):
+        framer = simplerpc.LineFramer()
+        buf = bytearray(b'foobar\nbaz')
+
+        result = framer.unframe(buf, 3)
+
+        self.assertEqual(result, [b'foobar'])
+        self.assertEqual(buf, b'baz')
+
+    def test_unframe_partial(self):
+        framer = simplerpc.LineFramer()
+        buf = bytearray(b'foo')
+
+        result = framer.unframe(buf)
+
+        self.assertEqual(result, [])
+        self.assertEqual(buf, b'foo')
+
+
+class TestLenPrefixFramer(TestCase):
+    def test_frame(self):
+        framer = simplerpc.LenPrefixFramer()
+
+        self.assertEqual(framer.frame(b'foo'), b'\0\0\0\x03foo')
+
+    def test_unframe(self):
+        framer = simplerpc.LenPrefixFramer()
+        buf = bytearray(b'\0\0\0\x03foo\0\0\0\0\0\0\0\x04ba')
+
+        result = framer.unframe(buf)
+
+        self.assertEqual(result, [b'foo', b''])
+        self.assertEqual(buf, b'\0\0\0\x04ba')
+
+    def test_unframe_partial_header(self):
+        framer = simplerpc.LenPrefixFramer()
+        buf = bytearray(b'\0\0\0')
+
+        result = framer.unframe(buf)
+
+        self.assertEqual(result, [])
+        self.assertEqual(buf, b'\0\0\0')
+
+
 class FakeSocket(object):
     def __init__(self, *msgs, **kwargs):
-        self._send_data = []
-        self._recv_data = []
+        self._send_buf = bytearray()
+        self._send_calls = 0
+        self._recv_data = collections.deque(msgs)
         self._actions = []
         self._fail = kwargs.get('fail')
-        self._clients = kwargs.get('clients', [])
+        self._clients = collections.deque(kwargs.get('clients', []))
         self._closed = False
 
-        if msgs:
-            self._recv_data.extend(msgs)
-
     def _check_closed(self):
         if self._closed:
             raise socket.error(errno.EBADF, 'Bad file descriptor')
@@ -135,14 +291,21 @@ class FakeSocket(object):
 
     def sendall(self, msg):
         self._check_closed()
-        self._send_data.append(msg)
+        self._send_buf += msg
+        self._send_calls += 1
 
-    def recv(self, size):
+    def recv_into(self, buf):
         self._check_closed()
         if not self._recv_data:
             self._closed = True
-            return ''
-        return self._recv_data.pop(0)
+            return 0
+        data = self._recv_data.popleft()
+        if len(data) > len(buf):
+            # Save the remainder for the next call
+            self._recv_data.appendleft(data[len(buf):])
+            data = data[:len(buf)]
+        buf[:len(data)] = data
+        return len(data)
 
     def setsockopt(self, *args, **kwargs):
         self._actions.append(('setsockopt', args, kwargs))
@@ -162,7 +325,7 @@ class FakeSocket(object):
     def accept(self):
         if not self._clients:
             raise socket.error("out of clients")
-        tmp = self._clients.pop(0)
+        tmp = self._clients.popleft()
         if isinstance(tmp, Exception):
             raise tmp
         return tmp, ('localhost', 1023)
@@ -175,10 +338,23 @@ class TestConnection(TestCase):
 
         conn.send('FOO', 'Nobody', 'inspects', 'the', 'spammish', 'repetition')
 
-        self.assertEqual(sock._send_data, [
-                '{"cmd": "FOO", "payload": ["Nobody", "inspects", "the", '
-                '"spammish", "repetition"]}\n'
-                ])
+        self.assertEqual(sock._send_calls, 1)
+        self.assertEqual(sock._send_buf,
+                         b'{"cmd":"FOO","payload":["Nobody","inspects","the",'
+                         b'"spammish","repetition"]}\n')
+
+    def test_send_lenprefix(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'framer', simplerpc.LenPrefixFramer())
+
+        conn.send('FOO', 'spam')
+
+        self.assertEqual(sock._send_calls, 1)
+        size, = struct.unpack('!I', bytes(sock._send_buf)[:4])
+        self.assertEqual(size, len(sock._send_buf) - 4)
+        self.assertEqual(json.loads(bytes(sock._send_buf)[4:]),
+                         dict(cmd='FOO', payload=['spam']))
 
     def test_send_closed(self):
         conn = simplerpc.Connection(None)
@@ -196,11 +372,70 @@ class TestConnection(TestCase):
                           'inspects', 'the', 'spammish', 'repetition')
         self.assertEqual(conn._sock, None)
 
+    def test_send_deferred(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'flush_on_send', False)
+
+        conn.send('FOO', 'spam')
+        conn.send('BAR', 'spam')
+
+        self.assertEqual(sock._send_buf, b'')
+        self.assertEqual(conn._sendbuf.count(b'\n'), 2)
+
+        conn.flush()
+
+        self.assertEqual(sock._send_calls, 1)
+        self.assertEqual(
+            [json.loads(msg) for msg in bytes(sock._send_buf).splitlines()],
+            [dict(cmd='FOO', payload=['spam']),
+             dict(cmd='BAR', payload=['spam'])])
+        self.assertEqual(conn._sendbuf, b'')
+
+    def test_send_deferred_full(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'flush_on_send', False)
+        self.stub(simplerpc.Connection, 'flush_size', 64)
+
+        conn.send('FOO', 'spam')
+
+        self.assertEqual(sock._send_buf, b'')
+
+        conn.send('BAR', 'x' * 64)
+
+        self.assertEqual(sock._send_calls, 1)
+        self.assertEqual(conn._sendbuf, b'')
+
+    def test_flush_empty(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+
+        conn.flush()
+
+        self.assertEqual(sock._send_buf, b'')
+
+    def test_flush_closed(self):
+        conn = simplerpc.Connection(None)
+        conn._sendbuf = bytearray(b'foo\n')
+
+        self.assertRaises(simplerpc.ConnectionClosed, conn.flush)
+
+    def test_flush_error(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'flush_on_send', False)
+        conn.send('FOO', 'spam')
+        sock.close()  # Make it raise an error
+
+        self.assertRaises(socket.error, conn.flush)
+        self.assertEqual(conn._sock, None)
+        self.assertEqual(conn._sendbuf, b'')
+
     def test_recvbuf_pop_msg(self):
         conn = simplerpc.Connection(None)
-        conn._recvbuf.append(dict(cmd='FOO', payload=['Nobody', 'inspects',
-                                                      'the', 'spammish',
-                                                      'repetition']))
+        conn._recvbuf.append(('FOO', ['Nobody', 'inspects', 'the',
+                                      'spammish', 'repetition']))
         result = conn._recvbuf_pop()
 
         self.assertEqual(result, ('FOO', ['Nobody', 'inspects', 'the',
@@ -215,45 +450,58 @@ class TestConnection(TestCase):
         sock = FakeSocket()
         conn = simplerpc.Connection(sock)
         conn._recvbuf.append('foo')
-        conn._recvbuf_partial = 'bar'
+        conn._recvbuf_partial = bytearray(b'bar')
 
         conn.close()
 
         self.assertTrue(sock._closed)
         self.assertEqual(conn._sock, None)
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
 
+    def test_close_flushes(self):
+        sock = FakeSocket()
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'flush_on_send', False)
+        conn.send('FOO', 'spam')
+
+        conn.close()
+
+        self.assertTrue(sock._closed)
+        self.assertEqual(sock._send_calls, 1)
+        self.assertEqual(conn._sock, None)
+        self.assertEqual(conn._sendbuf, b'')
+
     def test_close_double(self):
         conn = simplerpc.Connection(None)
         conn._recvbuf.append('foo')
-        conn._recvbuf_partial = 'bar'
+        conn._recvbuf_partial = bytearray(b'bar')
 
         conn.close()
 
         self.assertEqual(conn._sock, None)
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
 
     def stub_recvbuf_pop(self):
         def fake_recvbuf_pop(self):
             # I don't want to bother putting real messages on the
             # queue
-            return self._recvbuf.pop(0)
+            return self._recvbuf.popleft()
 
-        self.stubs.Set(simplerpc.Connection, '_recvbuf_pop', fake_recvbuf_pop)
-        self.stubs.Set(json, 'loads', lambda x: x)
+        self.stub(simplerpc.Connection, '_recvbuf_pop', fake_recvbuf_pop)
+        self.stub(simplerpc, '_decode_message', lambda x: x)
 
     def test_recv_recvbuf_filled(self):
         self.stub_recvbuf_pop()
 
         conn = simplerpc.Connection(None)
-        conn._recvbuf = ['foo', 'bar']
+        conn._recvbuf = collections.deque(['foo', 'bar'])
 
         result = conn.recv()
 
         self.assertEqual(result, 'foo')
-        self.assertEqual(conn._recvbuf, ['bar'])
+        self.assertEqual(list(conn._recvbuf), ['bar'])
 
     def test_recv_recvbuf_empty_closed(self):
         self.stub_recvbuf_pop()
@@ -270,24 +518,36 @@ class TestConnection(TestCase):
 
         result = conn.recv()
 
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foobar', sock, [], ''))
+
+    def test_recv_flushes(self):
+        self.stub_recvbuf_pop()
+
+        sock = FakeSocket('foobar\n')
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'flush_on_send', False)
+        conn.send('FOO', 'spam')
+
+        result = conn.recv()
+
         self.assertEqual(result, 'foobar')
-        self.assertEqual(conn._sock, sock)
-        self.assertEqual(conn._recvbuf, [])
-        self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual(sock._send_calls, 1)
+        self.assertEqual(conn._sendbuf, b'')
 
     def test_recv_onemsg_existing_partial(self):
         self.stub_recvbuf_pop()
 
         sock = FakeSocket('bar\n')
         conn = simplerpc.Connection(sock)
-        conn._recvbuf_partial = 'foo'
+        conn._recvbuf_partial = bytearray(b'foo')
 
         result = conn.recv()
 
-        self.assertEqual(result, 'foobar')
-        self.assertEqual(conn._sock, sock)
-        self.assertEqual(conn._recvbuf, [])
-        self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foobar', sock, [], ''))
 
     def test_recv_onemsg_onepartial(self):
         self.stub_recvbuf_pop()
@@ -297,10 +557,9 @@ class TestConnection(TestCase):
 
         result = conn.recv()
 
-        self.assertEqual(result, 'bar')
-        self.assertEqual(conn._sock, sock)
-        self.assertEqual(conn._recvbuf, [])
-        self.assertEqual(conn._recvbuf_partial, 'foo')
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('bar', sock, [], 'foo'))
 
     def test_recv_multimsg(self):
         self.stub_recvbuf_pop()
@@ -310,10 +569,9 @@ class TestConnection(TestCase):
 
         result = conn.recv()
 
-        self.assertEqual(result, 'foo')
-        self.assertEqual(conn._sock, sock)
-        self.assertEqual(conn._recvbuf, ['bar', 'baz'])
-        self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foo', sock, ['bar', 'baz'], ''))
 
     def test_recv_longmsg(self):
         self.stub_recvbuf_pop()
@@ -323,10 +581,58 @@ class TestConnection(TestCase):
 
         result = conn.recv()
 
-        self.assertEqual(result, 'foobarbaz')
-        self.assertEqual(conn._sock, sock)
-        self.assertEqual(conn._recvbuf, [])
-        self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foobarbaz', sock, [], ''))
+
+    def test_recv_longmsg_multimsg(self):
+        self.stub_recvbuf_pop()
+
+        sock = FakeSocket('fo', 'o\nbar\nb', 'az\nqu')
+        conn = simplerpc.Connection(sock)
+
+        result = conn.recv()
+
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foo', sock, ['bar'], 'b'))
+
+        result = conn.recv()
+
+        self.assertEqual(result, 'bar')
+        self.assertEqual(list(conn._recvbuf), [])
+        self.assertEqual(conn._recvbuf_partial, 'b')
+
+        result = conn.recv()
+
+        self.assertEqual(result, 'baz')
+        self.assertEqual(list(conn._recvbuf), [])
+        self.assertEqual(conn._recvbuf_partial, 'qu')
+
+    def test_recv_bigmsg(self):
+        self.stub_recvbuf_pop()
+
+        sock = FakeSocket('x' * 100000 + '\n')
+        conn = simplerpc.Connection(sock)
+
+        result = conn.recv()
+
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('x' * 100000, sock, [], ''))
+
+    def test_recv_lenprefix(self):
+        self.stub_recvbuf_pop()
+
+        sock = FakeSocket('\0\0\0\x06foo', 'bar\0\0\0\x03baz')
+        conn = simplerpc.Connection(sock)
+        self.stub(simplerpc.Connection, 'framer', simplerpc.LenPrefixFramer())
+
+        result = conn.recv()
+
+        self.assertEqual((result, conn._sock, list(conn._recvbuf),
+                          conn._recvbuf_partial),
+                         ('foobar', sock, ['baz'], ''))
 
     def test_recv_closed(self):
         self.stub_recvbuf_pop()
@@ -336,7 +642,7 @@ class TestConnection(TestCase):
 
         self.assertRaises(simplerpc.ConnectionClosed, conn.recv)
         self.assertEqual(conn._sock, None)
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
 
     def test_recv_error(self):
@@ -348,14 +654,14 @@ class TestConnection(TestCase):
 
         self.assertRaises(socket.error, conn.recv)
         self.assertEqual(conn._sock, None)
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
 
 
 class FakeConnection(object):
     def __init__(self, msgs=None):
         self._sendbuf = []
-        self._recvbuf = msgs or []
+        self._recvbuf = collections.deque(msgs or [])
         self._closed = False
 
     def _check_closed(self):
@@ -367,10 +673,10 @@ class FakeConnection(object):
 
     def send(self, cmd, *payload):
         self._check_closed()
-        self._sendbuf.append(dict(cmd=cmd, payload=payload))
+        self._sendbuf.append((cmd, payload))
 
     def recv(self):
-        msg = self._recvbuf.pop(0)
+        msg = self._recvbuf.popleft()
         if isinstance(msg, Exception):
             raise msg
         return msg['cmd'], msg['payload']
@@ -384,7 +690,7 @@ class FakeSimpleRPC(object):
         self._msgs = msgs
         self._closed = False
 
-    def close(self):
+    def _disconnect(self):
         self._closed = True
 
     def connect(self):
@@ -427,10 +733,8 @@ class TestRemote(TestCase):
         self.assertEqual(result, 'foobar')
         self.assertNotEqual(rpc.conn, None)
         self.assertEqual(rpc.conn._sendbuf, [
-                dict(
-                    cmd='CALL',
-                    payload=('foobar', (1, 2, 3), dict(a=4, b=5, c=6)),
-                    )])
+                ('CALL', ('foobar', (1, 2, 3), dict(a=4, b=5, c=6))),
+                ])
         self.assertFalse(rpc._closed)
 
     def test_remote_complex_result(self):
@@ -441,10 +745,8 @@ class TestRemote(TestCase):
         self.assertEqual(result, (3, 2, 1))
         self.assertNotEqual(rpc.conn, None)
         self.assertEqual(rpc.conn._sendbuf, [
-                dict(
-                    cmd='CALL',
-                    payload=('foobar', (1, 2, 3), dict(a=4, b=5, c=6)),
-                    )])
+                ('CALL', ('foobar', (1, 2, 3), dict(a=4, b=5, c=6))),
+                ])
         self.assertFalse(rpc._closed)
 
     def test_remote_exception(self):
@@ -483,6 +785,14 @@ class TestRemote(TestCase):
                              "Invalid command response from server: FOO")
         self.assertTrue(rpc._closed)
 
+    def test_remote_recv_error(self):
+        rpc = FakeSimpleRPC('client', [
+                simplerpc.ConnectionClosed("Connection closed"),
+                ])
+
+        self.assertRaises(simplerpc.ConnectionClosed, rpc.foobar)
+        self.assertTrue(rpc._closed)
+
 
 class TestCreateServer(TestCase):
     def setUp(self):
@@ -514,8 +824,8 @@ class TestCreateServer(TestCase):
 
             return sock
 
-        self.stubs.Set(socket, 'getaddrinfo', fake_getaddrinfo)
-        self.stubs.Set(socket, 'socket', fake_socket)
+        self.stub(socket, 'getaddrinfo', fake_getaddrinfo)
+        self.stub(socket, 'socket', fake_socket)
 
     def test_noaddrs(self):
         try:
@@ -550,6 +860,106 @@ class TestCreateServer(TestCase):
         self.assertEqual(sock._closed, False)
 
 
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+
+        self.cur_time = 1000.0
+        self.stub(simplerpc, '_clock', lambda: self.cur_time)
+
+    def test_init(self):
+        pool = simplerpc.ConnectionPool(4, 10.0)
+
+        self.assertEqual(pool.max_idle, 4)
+        self.assertEqual(pool.check_after, 10.0)
+        self.assertEqual(pool._idle, {})
+
+    def test_acquire_empty(self):
+        pool = simplerpc.ConnectionPool()
+
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
+
+    def test_release_acquire(self):
+        conn1 = FakeConnection()
+        conn2 = FakeConnection()
+        pool = simplerpc.ConnectionPool()
+
+        pool.release('localhost', 'port', 'authkey', conn1)
+        pool.release('localhost', 'port', 'authkey', conn2)
+
+        self.assertEqual(pool.acquire('localhost', 'port', 'other'), None)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), conn2)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), conn1)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
+        self.assertEqual(conn1._sendbuf, [])
+        self.assertEqual(conn2._sendbuf, [])
+
+    def test_release_full(self):
+        conns = [FakeConnection() for i in range(3)]
+        pool = simplerpc.ConnectionPool(2)
+
+        for conn in conns:
+            pool.release('localhost', 'port', 'authkey', conn)
+
+        self.assertEqual(conns[0]._closed, True)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'),
+                         conns[2])
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'),
+                         conns[1])
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
+
+    def test_release_disabled(self):
+        conn = FakeConnection()
+        pool = simplerpc.ConnectionPool(0)
+
+        pool.release('localhost', 'port', 'authkey', conn)
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(pool._idle, {})
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
+
+    def test_acquire_stale(self):
+        conn = FakeConnection([dict(cmd='PONG', payload=(1031.0,))])
+        pool = simplerpc.ConnectionPool()
+        pool.release('localhost', 'port', 'authkey', conn)
+        self.cur_time = 1031.0
+
+        result = pool.acquire('localhost', 'port', 'authkey')
+
+        self.assertEqual(result, conn)
+        self.assertEqual(conn._sendbuf, [('PING', (1031.0,))])
+        self.assertEqual(conn._closed, False)
+
+    def test_acquire_stale_badresponse(self):
+        conn = FakeConnection([dict(cmd='ERR', payload=('wassup?',))])
+        pool = simplerpc.ConnectionPool()
+        pool.release('localhost', 'port', 'authkey', conn)
+        self.cur_time = 1031.0
+
+        result = pool.acquire('localhost', 'port', 'authkey')
+
+        self.assertEqual(result, None)
+        self.assertEqual(conn._closed, True)
+
+    def test_acquire_stale_closed(self):
+        conn1 = FakeConnection([dict(cmd='PONG', payload=(1040.0,))])
+        conn2 = FakeConnection([
+                simplerpc.ConnectionClosed("Connection closed"),
+                ])
+        pool = simplerpc.ConnectionPool()
+        pool.release('localhost', 'port', 'authkey', conn1)
+        self.cur_time = 1005.0
+        pool.release('localhost', 'port', 'authkey', conn2)
+        self.cur_time = 1040.0
+
+        result = pool.acquire('localhost', 'port', 'authkey')
+
+        self.assertEqual(result, conn1)
+        self.assertEqual(conn1._closed, False)
+        self.assertEqual(conn2._closed, True)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
+
+
 class RPCforTest(simplerpc.SimpleRPC):
     connection_class = FakeConnection
 
@@ -576,7 +986,7 @@ class TestSimpleRPC(TestCase):
             self.addr = addr
             return self.msgs
 
-        self.stubs.Set(socket, 'create_connection', fake_create_connection)
+        self.stub(socket, 'create_connection', fake_create_connection)
 
     def test_init(self):
         rpc = RPCforTest('localhost', 'port', 'authkey')
@@ -587,6 +997,40 @@ class TestSimpleRPC(TestCase):
         self.assertEqual(rpc.mode, None)
         self.assertEqual(rpc.conn, None)
 
+    def test_init_no_cycle(self):
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        ref = weakref.ref(rpc)
+
+        # Without a reference cycle, the object is freed immediately
+        del rpc
+
+        self.assertEqual(ref(), None)
+
+    def test_remote_funcs(self):
+        result = RPCforTest._remote_funcs()
+
+        self.assertEqual(result, dict(
+                remote_func=RPCforTest.__dict__['remote_func'],
+                ))
+        self.assertTrue(RPCforTest._remote_funcs() is result)
+
+    def test_remote_funcs_subclass(self):
+        class RPCSubclass(RPCforTest):
+            @simplerpc.remote
+            def other_func(self):
+                pass
+
+        base = RPCforTest._remote_funcs()
+        result = RPCSubclass._remote_funcs()
+
+        self.assertEqual(base, dict(
+                remote_func=RPCforTest.__dict__['remote_func'],
+                ))
+        self.assertEqual(result, dict(
+                remote_func=RPCforTest.__dict__['remote_func'],
+                other_func=RPCSubclass.__dict__['other_func'],
+                ))
+
     def test_close(self):
         conn = FakeConnection()
         rpc = RPCforTest('localhost', 'port', 'authkey')
@@ -597,6 +1041,30 @@ class TestSimpleRPC(TestCase):
         self.assertEqual(rpc.conn, None)
         self.assertEqual(conn._closed, True)
 
+    def test_close_pool(self):
+        conn = FakeConnection()
+        pool = simplerpc.ConnectionPool()
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.connection_pool = pool
+        rpc.conn = conn
+
+        rpc.close()
+
+        self.assertEqual(rpc.conn, None)
+        self.assertEqual(conn._closed, False)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), conn)
+
+    def test_close_pool_disabled(self):
+        conn = FakeConnection()
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.connection_pool = simplerpc.ConnectionPool(0)
+        rpc.conn = conn
+
+        rpc.close()
+
+        self.assertEqual(rpc.conn, None)
+        self.assertEqual(conn._closed, True)
+
     def test_close_redundant(self):
         rpc = RPCforTest('localhost', 'port', 'authkey')
 
@@ -631,7 +1099,48 @@ class TestSimpleRPC(TestCase):
         self.assertEqual(rpc.mode, 'client')
         self.assertNotEqual(rpc.conn, None)
         self.assertEqual(rpc.conn._sendbuf,
-                         [dict(cmd='AUTH', payload=('authkey',))])
+                         [('AUTH', ('authkey',))])
+
+    def test_connect_pool(self):
+        conn = FakeConnection()
+        pool = simplerpc.ConnectionPool()
+        pool.release('localhost', 'port', 'authkey', conn)
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.connection_pool = pool
+
+        rpc.connect()
+
+        self.assertEqual(rpc.mode, 'client')
+        self.assertEqual(rpc.conn, conn)
+        self.assertEqual(self.addr, None)
+        self.assertEqual(conn._sendbuf, [])
+
+    def test_connect_pool_empty(self):
+        self.msgs.append(dict(cmd='OK', payload=()))
+        pool = simplerpc.ConnectionPool()
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.connection_pool = pool
+
+        rpc.connect()
+
+        self.assertEqual(rpc.mode, 'client')
+        self.assertNotEqual(rpc.conn, None)
+        self.assertEqual(self.addr, ('localhost', 'port'))
+        self.assertEqual(rpc.conn._sendbuf, [('AUTH', ('authkey',))])
+
+    def test_connect_err_pool(self):
+        self.msgs.append(dict(cmd='ERR', payload=('failed to auth',)))
+        pool = simplerpc.ConnectionPool()
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.connection_pool = pool
+
+        rpc.connect()
+
+        self.assertEqual(rpc.conn, None)
+        self.assertEqual(pool.acquire('localhost', 'port', 'authkey'), None)
 
     def test_connect_err(self):
         self.msgs.append(dict(cmd='ERR', payload=('failed to auth',)))
@@ -689,17 +1198,17 @@ class TestSimpleRPC(TestCase):
         def fake_connect(inst):
             inst.conn = conn
 
-        self.stubs.Set(RPCforTest, 'connect', fake_connect)
+        self.stub(RPCforTest, 'connect', fake_connect)
 
         return conn
 
     def test_ping(self):
-        cur_time = time.time()
+        cur_time = 1234567.0
 
-        def fake_time():
+        def fake_clock():
             return cur_time
 
-        self.stubs.Set(time, 'time', fake_time)
+        self.stub(simplerpc, '_clock', fake_clock)
 
         self.msgs.append(dict(cmd='PONG', payload=(cur_time - 60,)))
         conn = self.stub_for_connect()
@@ -711,7 +1220,7 @@ class TestSimpleRPC(TestCase):
         self.assertEqual(result, 60.0)
         self.assertEqual(rpc.conn, conn)
         self.assertEqual(conn._sendbuf,
-                         [dict(cmd='PING', payload=(cur_time,))])
+                         [('PING', (cur_time,))])
 
     def test_ping_fail(self):
         self.msgs.append(dict(cmd='FOO', payload=('hi there',)))
@@ -720,6 +1229,18 @@ class TestSimpleRPC(TestCase):
         rpc = RPCforTest('localhost', 'port', 'authkey')
 
         self.assertRaises(Exception, rpc.ping)
+        self.assertEqual(rpc.conn, None)
+        self.assertEqual(conn._closed, True)
+
+    def test_ping_error(self):
+        self.msgs.append(simplerpc.ConnectionClosed("Connection closed"))
+        conn = self.stub_for_connect()
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+
+        self.assertRaises(simplerpc.ConnectionClosed, rpc.ping)
+        self.assertEqual(rpc.conn, None)
+        self.assertEqual(conn._closed, True)
 
     def test_listen_client(self):
         rpc = RPCforTest('localhost', 'port', 'authkey')
@@ -739,8 +1260,8 @@ class TestSimpleRPC(TestCase):
             self.assertIsInstance(conn, FakeConnection)
             self.assertEqual(addr, ('localhost', 1023))
 
-        self.stubs.Set(simplerpc, '_create_server', fake_create_server)
-        self.stubs.Set(eventlet, 'spawn_n', fake_spawn_n)
+        self.stub(simplerpc, '_create_server', fake_create_server)
+        self.stub(eventlet, 'spawn_n', fake_spawn_n)
 
         rpc = RPCforTest('localhost', 'port', 'authkey')
 
@@ -769,8 +1290,7 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='ERR',
-                     payload=("Failed to parse command: Bad parse",)),
+                ('ERR', ("Failed to parse command: Bad parse",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Closing connection from 127.0.0.1 port 1023",
@@ -789,9 +1309,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='ERR',
-                     payload=("Failed to parse command: Bad parse",)),
+                ('OK', ()),
+                ('ERR', ("Failed to parse command: Bad parse",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -813,7 +1332,7 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='ERR', payload=("Invalid authentication key",)),
+                ('ERR', ("Invalid authentication key",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -821,6 +1340,51 @@ class TestSimpleRPC(TestCase):
                 "Closing connection from 127.0.0.1 port 1023",
                 ])
 
+    def test_serve_auth_unicode(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=(u'authkey',)),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ])
+
+    def test_serve_auth_nonstring(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=(1234,)),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 1234)
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ])
+
+    def test_serve_badauth_type(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=(1234,)),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('ERR', ("Invalid authentication key",)),
+                ])
+
     def test_serve_doubleauth(self):
         conn = FakeConnection([
                 dict(cmd='AUTH', payload=('authkey',)),
@@ -834,8 +1398,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='ERR', payload=("Already authenticated",)),
+                ('OK', ()),
+                ('ERR', ("Already authenticated",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -859,7 +1423,7 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='ERR', payload=("Not authenticated",)),
+                ('ERR', ("Not authenticated",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'PING' from 127.0.0.1 port 1023; payload: "
@@ -880,8 +1444,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='PONG', payload=(11111,)),
+                ('OK', ()),
+                ('PONG', (11111,)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -906,10 +1470,9 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='ERR', payload=(
-                        "Invalid payload for 'CALL' command: "
-                        "need more than 0 values to unpack",)),
+                ('OK', ()),
+                ('ERR', ("Invalid payload for 'CALL' command: "
+                         "expected 3 elements, received 0",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -934,10 +1497,10 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='EXC', payload=('exceptions:AttributeError',
-                                         "'RPCforTest' object has no "
-                                         "attribute 'nosuch_func'")),
+                ('OK', ()),
+                ('EXC', ('exceptions:AttributeError',
+                          "'RPCforTest' object has no "
+                          "attribute 'nosuch_func'")),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -962,10 +1525,10 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='EXC', payload=('exceptions:AttributeError',
-                                         "'RPCforTest' object has no "
-                                         "attribute 'remote_attr'")),
+                ('OK', ()),
+                ('EXC', ('exceptions:AttributeError',
+                          "'RPCforTest' object has no "
+                          "attribute 'remote_attr'")),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -990,10 +1553,10 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='EXC', payload=('exceptions:AttributeError',
-                                         "'RPCforTest' object has no "
-                                         "attribute 'noremote_func'")),
+                ('OK', ()),
+                ('EXC', ('exceptions:AttributeError',
+                          "'RPCforTest' object has no "
+                          "attribute 'noremote_func'")),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -1020,9 +1583,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='EXC', payload=('test_simplerpc:TestException',
-                                         "testing")),
+                ('OK', ()),
+                ('EXC', ('test_simplerpc:TestException', "testing")),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -1048,8 +1610,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='RES', payload=(('remote_func', (1, 2), dict(a=4)),)),
+                ('OK', ()),
+                ('RES', (('remote_func', (1, 2), dict(a=4)),)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -1061,6 +1623,44 @@ class TestSimpleRPC(TestCase):
                 "Closing connection from 127.0.0.1 port 1023",
                 ])
 
+    def test_serve_call_result_nokwargs(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=('authkey',)),
+                dict(cmd='CALL', payload=('remote_func', (1, 2), {})),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.mode = 'server'
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ('RES', (('remote_func', (1, 2), {}),)),
+                ])
+
+    def test_serve_call_badkwargs(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=('authkey',)),
+                dict(cmd='CALL', payload=('remote_func', (1, 2), [])),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+        rpc.mode = 'server'
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ('EXC', ('exceptions:TypeError',
+                         "remote_func() argument after ** must be a "
+                         "mapping, not list")),
+                ])
+
     def test_serve_unknown(self):
         conn = FakeConnection([
                 dict(cmd='AUTH', payload=('authkey',)),
@@ -1074,8 +1674,8 @@ class TestSimpleRPC(TestCase):
 
         self.assertEqual(conn._closed, True)
         self.assertEqual(conn._sendbuf, [
-                dict(cmd='OK', payload=()),
-                dict(cmd='ERR', payload=("Unrecognized command 'XXXX'",)),
+                ('OK', ()),
+                ('ERR', ("Unrecognized command 'XXXX'",)),
                 ])
         self.assertEqual(self.log_messages, [
                 "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
@@ -1087,6 +1687,74 @@ class TestSimpleRPC(TestCase):
                 "Closing connection from 127.0.0.1 port 1023",
                 ])
 
+    def test_serve_unknown_unauth(self):
+        conn = FakeConnection([
+                dict(cmd='XXXX', payload=()),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('ERR', ("Not authenticated",)),
+                ])
+        self.assertEqual(self.log_messages, [
+                "Received command 'XXXX' from 127.0.0.1 port 1023; payload: "
+                "()",
+                "Closing connection from 127.0.0.1 port 1023",
+                ])
+
+    def test_serve_unhashable(self):
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=('authkey',)),
+                dict(cmd=['XXXX'], payload=()),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCforTest('localhost', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ('ERR', ("Unrecognized command ['XXXX']",)),
+                ])
+        self.assertEqual(self.log_messages, [
+                "Received command 'AUTH' from 127.0.0.1 port 1023; payload: "
+                "('authkey',)",
+                "Received command ['XXXX'] from 127.0.0.1 port 1023; payload: "
+                "()",
+                "Received command 'QUIT' from 127.0.0.1 port 1023; payload: "
+                "()",
+                "Closing connection from 127.0.0.1 port 1023",
+                ])
+
+    def test_serve_override(self):
+        class RPCOverride(RPCforTest):
+            def _serve_ping(self, conn, cmd, payload, auth):
+                conn.send('PONG', 'overridden')
+                return auth
+
+        conn = FakeConnection([
+                dict(cmd='AUTH', payload=('authkey',)),
+                dict(cmd='PING', payload=(11111,)),
+                dict(cmd='QUIT', payload=()),
+                ])
+
+        rpc = RPCOverride('localhost', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1023))
+
+        self.assertEqual(conn._closed, True)
+        self.assertEqual(conn._sendbuf, [
+                ('OK', ()),
+                ('PONG', ('overridden',)),
+                ])
+
     def test_serve_closed(self):
         conn = FakeConnection([
                 simplerpc.ConnectionClosed("Connection closed"),